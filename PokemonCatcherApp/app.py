@@ -5,120 +5,185 @@ For Pokemon Let's Go.
 
 #%% Library imports
 import os
+import functools
+import bisect
 from random import choice, randint
-import json
-from io import BytesIO
-import pandas as pd
-from dash import Dash, Input, Output, callback, dcc, html, ctx
-from PIL import Image
-import requests
-import numpy as np
+import sqlite3
+import tempfile
+import threading
+import orjson
+from dash import Dash, Input, Output, State, callback, dcc, html, ctx, no_update
+from dash.exceptions import PreventUpdate
 
 
 #%% Database loading and configuration
 DATASOURCES_PATH = os.path.join(os.getcwd(), r"resources")
 DATABASE_PATH = os.path.join(DATASOURCES_PATH, r"pokemonletsgo_db.json")
-UTILS_PATH = os.path.join(DATASOURCES_PATH, r"utils.json")
-
-with open(DATABASE_PATH, "r", encoding="utf-8") as database,\
-     open(UTILS_PATH, "r", encoding="utf-8") as utils:
-    pokemon_db = json.load(database)
-    utils_json = json.load(utils)
-
-pokemon_dict = pokemon_db["pokemon"]
+SQLITE_PATH = os.path.join(DATASOURCES_PATH, r"pokemonletsgo.sqlite3")
+ASSETS_PATH = os.path.join(os.getcwd(), r"assets")
+LOGO_PATH = os.path.join(ASSETS_PATH, r"logo.png")
+
+with open(DATABASE_PATH, "rb") as database:
+    pokemon_db = orjson.loads(database.read())
+
+# Catch progress (times_caught, shiny_caught) is stored in SQLite, seeded
+# from the JSON database. Rows already present are kept, so workers starting
+# together can all seed.
+connection = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+connection.execute("PRAGMA journal_mode=WAL")
+connection.execute(
+    """CREATE TABLE IF NOT EXISTS pokemon (
+        name TEXT PRIMARY KEY,
+        times_caught INT,
+        shiny_caught TEXT
+    )"""
+)
+connection.executemany(
+    "INSERT OR IGNORE INTO pokemon (name, times_caught, shiny_caught) VALUES (?, ?, ?)",
+    [(name, pokemon["times_caught"], pokemon["shiny_caught"])
+     for name, pokemon in pokemon_db["pokemon"].items()]
+)
+connection.commit()
+db_lock = threading.Lock()
+
+# Fields that never change come from the JSON database, times_caught and
+# shiny_caught are read from SQLite (see get_progress)
+pokemon_dict = {
+    name: {
+        "sprite": pokemon["sprite"],
+        "catch_rate": pokemon["catch_rate"],
+        "cry": pokemon["cry"],
+    }
+    for name, pokemon in pokemon_db["pokemon"].items()
+}
 ballrate_dict = pokemon_db["ball_rate"]
 technique_dict = pokemon_db["technique"]
 berry_dict = pokemon_db["berry"]
-pokemonchain_dict = pokemon_db["letsgochain"]
-
-# Global variables
-chaintext = html.Td("No chain", style={"font-weight": "normal"})
-INIT_STATE = True
 
-# Get the game logo
+# Names for the dropdowns
+POKEMON_NAMES = tuple(pokemon_dict)
+BALL_NAMES = tuple(ballrate_dict)
+BERRY_NAMES = tuple(berry_dict)
+# Pokemon names without the pokedex number, for the chain text
+DISPLAY_NAMES = {name: name.rpartition("-")[2] for name in pokemon_dict}
+
+# Technique rates in display order, as a flat sequence for the rate loop
+TECHNIQUE_VALS = tuple(technique_dict.values())
+
+# Catch rate formula exponents
+CATCHRATE_EXP = 1 / 1.85
+CP_EXP = 1 / 4
+BALL_EXP = 3 / 2
+TECHNIQUE_EXP = 1 / 2
+SHAKE_EXP = 1 / 5.33
+
+# Catch ring colors and the catch rate thresholds between them
+RING_COLORS = ("red", "orange", "gold", "green")
+RING_THRESHOLDS = (70.0, 75.0, 80.0)
+RING_STYLES = {color: {"border": f"4px solid {color}", "font-weight": "bold"}
+               for color in RING_COLORS}
+
+# Game logo, downloaded once to the assets folder
 LOGO_URL = "https://archives.bulbagarden.net/media/upload/thumb/8/8b/Pok%C3%A9mon_Lets_Go_Eevee_Logo.png/800px-Pok%C3%A9mon_Lets_Go_Eevee_Logo.png?20180530032955"
-response = requests.get(LOGO_URL, timeout=5)
-game_logo = Image.open(BytesIO(response.content))
 
 
 #%% Functions
-def catch_pokemon(pokemon: str, combat_power: int, ball: str, berry: str) -> list:
+@functools.lru_cache(maxsize=4096)
+def base_catchrate(catch_rate_v: float, times_caught: int, combat_power: int,
+                   ballrate_v: float) -> float:
+    """
+    Function to calculate the part of the catch rate formula shared by every
+    technique, based on:
+    - The pokemon species catch rate
+    - Times caught
+    - CP
+    - Ball rate
+    For Pokemon Let's Go.
+
+    Returns:
+        A float of the shared factor.
+    """
+    caught = min(100, times_caught)
+    return (1.25
+        * catch_rate_v ** CATCHRATE_EXP
+        * (10000 / ((100 - caught) / 100 * combat_power + 1)) ** CP_EXP
+        * ballrate_v ** BALL_EXP
+    )
+
+@functools.lru_cache(maxsize=4096)
+def catchrate_calc(catch_rate_v: float, times_caught: int, combat_power: int,
+                   ballrate_v: float, technique_v: float, berry_v: float) -> float:
+    """
+    Function to calculate the catch rate of a pokemon based on:
+    - The pokemon species catch rate
+    - Times caught
+    - CP
+    - Ball rate
+    - Tecnique rate
+    - Berry rate
+    For Pokemon Let's Go.
+
+    Returns:
+        A float of the catch rate.
+    """
+    a = (base_catchrate(catch_rate_v, times_caught, combat_power, ballrate_v)
+         * (technique_v * berry_v) ** TECHNIQUE_EXP)
+
+    # print(f"a: {a}")
+    # b = 65535 / a ** (5 / 16)
+    b = 65535 / (255 / a) ** SHAKE_EXP
+    # print(f"b: {b}")
+    catch_rate = (b / 65535) * 100
+    # print(f"Catch rate: {(catch_rate)}")
+    catch_rate = min(100, catch_rate)
+
+    return round(catch_rate, 2)
+
+@functools.lru_cache(maxsize=1024)
+def catch_pokemon(pokemon: str, combat_power: int, ball: str, berry: str,
+                  times_caught: int) -> tuple:
     """
     Function handler to calculate the possible catch rates of a pokemon based on:
     - The pokemon species
     - CP
     - Ball type
     - Berry type
+    - Times caught
     For Pokemon Let's Go.
+    Results are memoized, times_caught is part of the key so a new catch
+    is never served a stale rate.
 
     Returns:
-        A list of catch rates for each technique.
+        A tuple of catch rates for each technique.
     """
+    catch_rate_v = pokemon_dict[pokemon]["catch_rate"]
+    ballrate_v = ballrate_dict[ball]
+    berry_v = berry_dict[berry]
+
+    # Calculate the catch rate
+    return tuple(
+        catchrate_calc(catch_rate_v, times_caught, combat_power, ballrate_v,
+                       technique_v, berry_v)
+        for technique_v in TECHNIQUE_VALS
+    )
 
-    def catchrate_calc(technique: str) -> float:
-        """
-        Function to calculate the catch rate of a pokemon based on:
-        - The pokemon species
-        - CP
-        - Ball type
-        - Tecnique
-        - Berry type
-        For Pokemon Let's Go.
-
-        Returns:
-            A float of the catch rate.
-        """
-        times_caught = min(100, pokemon_dict[pokemon]["times_caught"])
-
-        a = (1.25
-            * np.pow( pokemon_dict[pokemon]["catch_rate"],(1 / 1.85) )
-            * np.pow( (10000 / ((100 - times_caught) / 100 * combat_power + 1)), (1 / 4) )
-            * np.pow( ballrate_dict[ball], (3 / 2) )
-            * np.pow( (technique_dict[technique] * berry_dict[berry]), (1 / 2) )
-        )
-
-        # a = (
-        #     1.25 * pokemon_dict[pokemon]["catch_rate"] ** (1 / 1.85)
-        #     * (10000 / ((100 - times_caught) / 100 * combat_power + 1)) ** (1 / 4)
-        #     * ballrate_dict[ball] ** (3 / 2)
-        #     * (technique_dict[technique] * berry_dict[berry]) ** (1 / 2)
-        # )
-
-<<<<<<< HEAD
-        # print(f"a: {a}")
-        # b = 65535 / np.pow(a, (5 / 16))
-        b = 65535 / np.pow(255 / a, (1 / 5.33))
-        # print(f"b: {b}")
-        catch_rate = (b / 65535) * 100
-        # print(f"Catch rate: {(catch_rate)}")
-=======
-        print(f"a: {a}")
-        # b = 65535 / np.pow(a, (5 / 16))
-        b = 65535 / np.pow(255 / a, (1 / 5.33))
-        print(f"b: {b}")
-        catch_rate = (b / 65535) * 100
-        print(f"Catch rate: {(catch_rate)}")
->>>>>>> 33a3edbd6c13220bcde424409ca33d117197cda2
-        catch_rate = min(100, catch_rate)
-
-        return round(catch_rate, 2)
-
-    # Check if the pokemon, ball, technique, and berry are valid
+def check_inputs(pokemon: str, cp: int, ball: str, berry: str) -> bool:
+    """
+    Function to check if the pokemon, CP, ball and berry are valid.
+    """
     if pokemon not in pokemon_dict:
         print("Pokemon not found")
-        return None
+        return False
+    if cp is None or cp <= 0:
+        print("CP must be a positive number")
+        return False
     if ball not in ballrate_dict:
         print("Ball not found")
-        return None
+        return False
     if berry not in berry_dict:
         print("Berry not found")
-        return None
-
-    # Calculate the catch rate
-    return pd.DataFrame(
-                [[technique, catchrate_calc(technique)] for technique in technique_dict],
-                columns=["Technique", "Catch Rate"]
-                )
+        return False
+    return True
 
 def catchring_color(catch_rate: float) -> str:
     """
@@ -129,79 +194,119 @@ def catchring_color(catch_rate: float) -> str:
     # 75<=CR<80%: yellow
     # 80<=CR: green
     """
-    color_thresholds = {
-        "orange": 70.0,
-        "yellow": 75.0,
-        "green": 80.0,
-    }
-    if catch_rate < color_thresholds["orange"]:
-        return "red"
-    if color_thresholds["orange"] <= catch_rate < color_thresholds["yellow"]:
-        return "orange"
-    if color_thresholds["yellow"] <= catch_rate < color_thresholds["green"]:
-        return "gold"
-    return "green"
+    return RING_COLORS[bisect.bisect_right(RING_THRESHOLDS, catch_rate)]
 
 def get_sprite(pokemon: str, shiny: bool = False) -> str:
     """
     Function to get the sprite URL of a pokemon.
+    The browser downloads the sprite itself.
     """
     if shiny:
-        url=pokemon_dict[pokemon]["sprite"]["shiny"]
-    else:
-        url=pokemon_dict[pokemon]["sprite"]["regular"]
+        return pokemon_dict[pokemon]["sprite"]["shiny"]
+    return pokemon_dict[pokemon]["sprite"]["regular"]
 
-    urlresponse = requests.get(url, timeout=5)
-    return Image.open(BytesIO(urlresponse.content))
+def chain_cell(chain_state: dict) -> html.Td:
+    """
+    Function to build the chain text cell from the chain state.
+    """
+    if chain_state["value"] == 0:
+        return html.Td("No chain", style={"font-weight": "normal"})
+
+    name = DISPLAY_NAMES.get(chain_state["name"], chain_state["name"])
+    return html.Td(f'Chain of {chain_state["value"]} {name}!',
+                   style={"color":"SteelBlue" ,"font-weight": "bold"})
 
-def triggers_handler(trigger: str, pokemonname: str, shinyradio: str):
+def triggers_handler(trigger: str, pokemonname: str, shinyradio: str,
+                     chain_state: dict) -> dict:
     """
     Function to handle the triggers of the app.
-    """
-    global chaintext
 
+    Returns:
+        The updated chain state.
+    """
     if trigger == "add1_btn":
         # + button was clicked
-        # Add 1 to the number of times caught and update the pokemon_db
-        pokemon_dict[pokemonname]["times_caught"] += 1
+        # Add 1 to the number of times caught in the database
+        update_database("UPDATE pokemon SET times_caught = times_caught + 1 WHERE name = ?",
+                        (pokemonname,))
         # Add 1 to the chain if the pokemon is the same as the last one caught
-        # or reset the chain if a different pokemon was caught
-        if pokemonchain_dict["pokemonname"] != pokemonname:
-            pokemonchain_dict["pokemonname"] = pokemonname
-            pokemonchain_dict["chainvalue"] = 0
-
-        # Update chain text and chain value
-        pokemonchain_dict["chainvalue"] += 1
-        pokemonchain_dict["chaintext"] = f'Chain of {pokemonchain_dict["chainvalue"]} {pokemonname.split("-")[-1]}!'
-        chaintext = html.Td(pokemonchain_dict["chaintext"], style={"color":"SteelBlue" ,"font-weight": "bold"})
-    elif ctx.triggered_id == "resetchain_btn":
+        # or start a new chain if a different pokemon was caught
+        chainvalue = chain_state["value"] if chain_state["name"] == pokemonname else 0
+        return {"name": pokemonname, "value": chainvalue + 1}
+    if trigger == "resetchain_btn":
         # Reset button was clicked
-        pokemonchain_dict["chainvalue"] = 0
-        pokemonchain_dict["chaintext"] = "No chain"
-        chaintext = html.Td(pokemonchain_dict["chaintext"], style={"font-weight": "normal"})
-    elif ctx.triggered_id == "shinyradio":
+        return {"name": chain_state["name"], "value": 0}
+    if trigger == "shinyradio":
         # Shiny radio button was clicked
-        # Set the shiny_caught value in the pokemon_db
-        pokemon_dict[pokemonname]["shiny_caught"] = shinyradio
+        # Set the shiny_caught value in the database
+        update_database("UPDATE pokemon SET shiny_caught = ? WHERE name = ?",
+                        (shinyradio, pokemonname))
+    return chain_state
 
-    # Update the pokemon_db and utils.json files
-    with open(DATABASE_PATH, "w", encoding="utf-8") as database,\
-         open(UTILS_PATH, "w", encoding="utf-8") as utils:
-        json.dump(pokemon_db, database, indent=4)
-        json.dump(utils_json, utils, indent=4)
+def update_database(query: str, params: tuple):
+    """
+    Function to run an update on the pokemon database and commit it.
+    """
+    with db_lock:
+        connection.execute(query, params)
+        connection.commit()
+
+def get_progress(pokemon: str) -> tuple:
+    """
+    Function to get the times caught and shiny caught values of a pokemon.
+    They are read from the database so every worker sees the latest values.
+    """
+    with db_lock:
+        return connection.execute(
+            "SELECT times_caught, shiny_caught FROM pokemon WHERE name = ?",
+            (pokemon,)
+        ).fetchone()
+
+def get_logo(asset_url: str) -> str:
+    """
+    Function to get the source of the game logo.
+    The logo is downloaded once to the assets folder and served by Dash at
+    asset_url, the original URL is used if it cannot be downloaded.
+    """
+    if not os.path.exists(LOGO_PATH):
+        import requests
+
+        try:
+            response = requests.get(LOGO_URL, timeout=5)
+            response.raise_for_status()
+        except requests.RequestException:
+            print("Logo could not be downloaded")
+            return LOGO_URL
+        if not response.headers.get("Content-Type", "").startswith("image/"):
+            print("Logo download is not an image")
+            return LOGO_URL
+
+        # Write to a temporary file first so a partial download is never cached
+        os.makedirs(ASSETS_PATH, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=ASSETS_PATH, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as logo:
+                logo.write(response.content)
+            os.replace(tmp_path, LOGO_PATH)
+        except OSError:
+            os.remove(tmp_path)
+            print("Logo could not be saved")
+            return LOGO_URL
+
+    return asset_url
 
 #%% Dash app
-pokemontocatch = choice(list(pokemon_dict.keys()))
+pokemontocatch = choice(POKEMON_NAMES)
 combatpower = randint(1, 1000)
 
-app = Dash()
+app = Dash(assets_folder=ASSETS_PATH)
 server = app.server
 app.title = "PokemonCatcher"
 
 app.layout = (
     html.Div(
         [
-            html.Img(src=game_logo, style={"width": "15%"}),
+            html.Img(src=get_logo(app.get_asset_url("logo.png")), style={"width": "15%"}),
             html.H1("Catch Rate Calculator"),
             # Input data
             html.H3("Input data:"),
@@ -212,7 +317,7 @@ app.layout = (
                             html.Td("Pokemon to catch:"),
                             html.Td(
                                 dcc.Dropdown(
-                                    list(pokemon_dict.keys()),
+                                    POKEMON_NAMES,
                                     id="pokemonname",
                                     value=pokemontocatch,
                                 )
@@ -265,7 +370,7 @@ app.layout = (
                             html.Td("Pokeball type:"),
                             html.Td(
                                 dcc.Dropdown(
-                                    list(ballrate_dict.keys()),
+                                    BALL_NAMES,
                                     id="ball",
                                     value="pokeball",
                                 )
@@ -277,7 +382,7 @@ app.layout = (
                             html.Td("Berry type:"),
                             html.Td(
                                 dcc.Dropdown(
-                                    list(berry_dict.keys()), id="berry", value="none"
+                                    BERRY_NAMES, id="berry", value="none"
                                 )
                             ),
                         ]
@@ -298,6 +403,12 @@ app.layout = (
             ),
             html.Img(id="sprite_shiny"),
             html.Img(id="sprite_regular"),
+            # Catch chain of this browser, kept across visits
+            dcc.Store(
+                id="chain-state",
+                storage_type="local",
+                data={"name": "", "value": 0},
+            ),
         ]
     , style={'textAlign': 'center'}),
 )
@@ -313,7 +424,8 @@ app.layout = (
             Output("sprite_shiny", "src"),
             Output("sprite_regular", "src"),
             Output("shinyradio", "value"),
-            Output("cryaudio", "src")
+            Output("cryaudio", "src"),
+            Output("chain-state", "data")
             ],
     inputs=[Input("pokemonname", "value"),
             Input("cp", "value"),
@@ -323,27 +435,31 @@ app.layout = (
             Input("add1_btn", "n_clicks"),
             Input("resetchain_btn", "n_clicks")
             ],
+    state=[State("chain-state", "data")],
     running=[
             (Output("add1_btn", "disabled"), True, False),
             (Output("resetchain_btn", "disabled"), True, False)
             ]
 )
-def update_catchrates(pokemonname, cp, ball, berry, shinyradio, *_):
+def update_catchrates(pokemonname, cp, ball, berry, shinyradio,
+                      _add1_clicks, _resetchain_clicks, chain_state):
     """
     Callback function to update the catch rates based on the input data.
     """
-    global INIT_STATE
-    if INIT_STATE:
-        # Set the initial state of the app
-        global chaintext
-        chaintext = html.Td(pokemonchain_dict["chaintext"],
-                            style={"color":"SteelBlue" ,"font-weight": "bold"})
-        INIT_STATE = False
+    if not check_inputs(pokemonname, cp, ball, berry):
+        raise PreventUpdate
 
     # Triggers
-    triggers_handler(ctx.triggered_id, pokemonname, shinyradio)
+    chain_state = triggers_handler(ctx.triggered_id, pokemonname, shinyradio,
+                                   chain_state)
+    if ctx.triggered_id == "resetchain_btn":
+        # Only the chain changes
+        return (no_update,) * 5 + (chain_cell(chain_state),) + (no_update,) * 4 + (chain_state,)
+    if ctx.triggered_id == "shinyradio":
+        # The radio items already show the new value
+        return (no_update,) * 11
 
-    shinyradio = pokemon_dict[pokemonname]["shiny_caught"]
+    times_caught, shinyradio = get_progress(pokemonname)
 
     # Get the pokemon cry
     cryaudio = pokemon_dict[pokemonname]["cry"]
@@ -352,29 +468,28 @@ def update_catchrates(pokemonname, cp, ball, berry, shinyradio, *_):
     sprite_shiny = get_sprite(pokemonname, shiny=True)
 
     # Get the catch rates for the pokemon
-    techniquerate_df = catch_pokemon(
-        pokemon=pokemonname, combat_power=cp, ball=ball, berry=berry
-    )
-
-    # Set the catch ring color based on the catch rate
-    ringcolor_dict = {
-        "None": catchring_color(techniquerate_df["Catch Rate"][0]),
-        "Nice": catchring_color(techniquerate_df["Catch Rate"][1]),
-        "Great": catchring_color(techniquerate_df["Catch Rate"][2]),
-        "Excellent": catchring_color(techniquerate_df["Catch Rate"][3]),
+    rates = catch_pokemon(pokemonname, cp, ball, berry, times_caught)
+
+    # Set the catch ring style based on the catch rate
+    ringstyle_dict = {
+        "None": RING_STYLES[catchring_color(rates[0])],
+        "Nice": RING_STYLES[catchring_color(rates[1])],
+        "Great": RING_STYLES[catchring_color(rates[2])],
+        "Excellent": RING_STYLES[catchring_color(rates[3])],
     }
 
     return (
-        html.Td(f'None         {techniquerate_df["Catch Rate"][0]}%', style={"border": f'4px solid {ringcolor_dict["None"]}', "font-weight": "bold"}),
-        html.Td(f'Nice         {techniquerate_df["Catch Rate"][1]}%', style={"border": f'4px solid {ringcolor_dict["Nice"]}', "font-weight": "bold"}),
-        html.Td(f'Great        {techniquerate_df["Catch Rate"][2]}%', style={"border": f'4px solid {ringcolor_dict["Great"]}', "font-weight": "bold"}),
-        html.Td(f'Excellent    {techniquerate_df["Catch Rate"][3]}%', style={"border": f'4px solid {ringcolor_dict["Excellent"]}', "font-weight": "bold"}),
-        pokemon_dict[pokemonname]["times_caught"],
-        chaintext,
+        html.Td(f'None         {rates[0]}%', style=ringstyle_dict["None"]),
+        html.Td(f'Nice         {rates[1]}%', style=ringstyle_dict["Nice"]),
+        html.Td(f'Great        {rates[2]}%', style=ringstyle_dict["Great"]),
+        html.Td(f'Excellent    {rates[3]}%', style=ringstyle_dict["Excellent"]),
+        times_caught,
+        chain_cell(chain_state),
         sprite_regular,
         sprite_shiny,
         shinyradio,
-        cryaudio
+        cryaudio,
+        chain_state
     )
 #%% Run the app
 if __name__ == "__main__":